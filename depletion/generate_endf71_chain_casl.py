@@ -1,22 +1,22 @@
 #!/usr/bin/env python3
 
-import glob
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from multiprocessing import Pool
 import os
+import re
 from zipfile import ZipFile
-from collections import OrderedDict, defaultdict
-from io import StringIO
+from collections import OrderedDict, namedtuple
 from itertools import chain
 
 try:
-    import lxml.etree as ET
-    _have_lxml = True
+    import diskcache
+    _have_diskcache = True
 except ImportError:
-    import xml.etree.ElementTree as ET
-    _have_lxml = False
+    _have_diskcache = False
 
 import openmc.data
 import openmc.deplete
-from openmc._xml import clean_indentation
 from openmc.deplete.chain import _REACTIONS
 from openmc.deplete.nuclide import Nuclide, DecayTuple, ReactionTuple, \
     FissionYieldDistribution
@@ -30,70 +30,310 @@ URLS = [
     'https://www.nndc.bnl.gov/endf/b7.1/zips/ENDF-B-VII.1-nfy.zip'
 ]
 
+# ENDF/B-VII.1 sub-library filenames encode Z, symbol, A and metastable state,
+# e.g. n-092_U_235.endf, dec-095_Am_242m1.endf, nfy-094_Pu_239.endf
+_ENDF_FILENAME_RE = re.compile(r'[a-z]+-(\d+)_([A-Za-z]+)_(\d+)(?:m(\d+))?\.endf$')
+
+# Directory used to cache parsed ENDF data between runs. Caching is skipped if
+# diskcache is not installed or the NO_ENDF_CACHE environment variable is 1.
+_CACHE_DIR = '.endf_cache'
+
+# Cache opened lazily, once per process, by _get_cache()
+_cache = None
+
+# Increment whenever the format of the cached data changes
+_CACHE_VERSION = 1
+
+
+def _mt_mask(mts):
+    """Represent a collection of MT numbers as an integer bitmask."""
+    mask = 0
+    for mt in mts:
+        mask |= 1 << mt
+    return mask
+
+
+# Transmutation reactions with their MT numbers given as a bitmask, for
+# checking availability, and in sorted order so that summation reactions
+# (e.g., MT=103) are found first when looking up Q values
+_REACTIONS_SORTED = [(name, _mt_mask(mts), sorted(mts), changes)
+                     for name, mts, changes in _REACTIONS]
+
+# MT numbers indicating fission
+_FISSION_MASK = _mt_mask([18, 19, 20, 21, 38])
+
+# Subsets of openmc.data.Decay and openmc.data.FissionProductYields that are
+# needed to build the chain. Quantities with uncertainties are reduced to their
+# nominal values as plain floats.
+DecayData = namedtuple('DecayData', ['nuclide', 'half_life', 'decay_energy', 'modes'])
+DecayMode = namedtuple('DecayMode', ['modes', 'daughter', 'branching_ratio'])
+FPYData = namedtuple('FPYData', ['energies', 'independent', 'cumulative'])
+
+
+def _extract(basename):
+    """Extract a downloaded zip file into the current directory."""
+    with ZipFile(basename, 'r') as zf:
+        print('Extracting {}...'.format(basename))
+        zf.extractall()
+
+
+def _filename_to_gnd(path):
+    """Determine the GND name of a nuclide from an ENDF sub-library filename.
+
+    Returns None if the filename does not follow the NNDC naming convention.
+
+    """
+    match = _ENDF_FILENAME_RE.match(os.path.basename(path))
+    if match is None:
+        return None
+    _, symbol, A, state = match.groups()
+    name = '{}{}'.format(symbol, int(A))
+    if state is not None:
+        name += '_m{}'.format(state)
+    return name
+
+
+def _in_casl_chain(path):
+    """Cheaply check whether a file may contain a nuclide in the CASL chain.
+
+    Files whose names cannot be interpreted are kept so that they are still
+    checked after a full parse.
+
+    """
+    name = _filename_to_gnd(path)
+    return name is None or name in CASL_CHAIN
+
+
+def _endf_files(directory):
+    """List ENDF files in a directory for nuclides that may be in the CASL
+    chain, using a single directory scan."""
+    with os.scandir(directory) as it:
+        return [entry.path for entry in it
+                if entry.name.endswith('.endf') and _in_casl_chain(entry.name)]
+
+
+def _get_cache():
+    """Return the on-disk cache for this process, opening it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = diskcache.Cache(_CACHE_DIR)
+    return _cache
+
+
+def _cached(func):
+    """Decorator that caches the result of reading an ENDF file on disk, keyed
+    on the path and modification time of the file."""
+    @functools.wraps(func)
+    def wrapper(path):
+        if not _have_diskcache or os.environ.get('NO_ENDF_CACHE') == '1':
+            return func(path)
+
+        key = (func.__name__, _CACHE_VERSION, os.path.abspath(path),
+               os.path.getmtime(path))
+        cache = _get_cache()
+        result = cache.get(key)
+        if result is None:
+            result = func(path)
+            cache.set(key, result)
+        return result
+    return wrapper
+
+
+@_cached
+def _read_neutron(path):
+    """Read the nuclide name and reaction Q values from an ENDF neutron
+    sub-library file.
+
+    Rather than parsing the full evaluation, only the first two records of the
+    MF=1, MT=451 header and of each MF=3 section are interpreted, and reading
+    stops once MF=3 has been passed.
+
+    """
+    header = []
+    q_values = {}
+    current = None
+    with open(path, 'r') as fh:
+        for line in fh:
+            # Skip blank or truncated lines without MF/MT fields
+            if len(line) < 75:
+                continue
+            mf = int(line[70:72])
+            if mf > 3:
+                # Sections are ordered by MF, so nothing more is needed
+                break
+            mt = int(line[72:75])
+            if (mf, mt) != current:
+                current = (mf, mt)
+                n = 0
+            else:
+                n += 1
+
+            if mf == 1 and mt == 451 and n < 2:
+                header.append(line)
+            elif mf == 3 and mt != 0 and n == 1:
+                # Q value is the second field of the CONT record that follows
+                # the HEAD record of each MF=3 section
+                q_values[mt] = openmc.data.endf.float_endf(line[11:22])
+
+    if len(header) < 2:
+        raise ValueError('No MF=1, MT=451 header found in {}'.format(path))
+
+    # Determine nuclide from ZA in the HEAD record and isomeric state (LISO)
+    # in the following record
+    Z, A = divmod(int(openmc.data.endf.float_endf(header[0][:11])), 1000)
+    isomeric_state = int(header[1][33:44])
+    return openmc.data.gnd_name(Z, A, isomeric_state), q_values
+
+
+@_cached
+def _read_decay(path):
+    """Read the nuclide name and decay data from an ENDF decay sub-library
+    file."""
+    decay_obj = openmc.data.Decay(path)
+    modes = [DecayMode(mode.modes, mode.daughter,
+                       float(mode.branching_ratio.nominal_value))
+             for mode in decay_obj.modes]
+    decay_energy = sum(E.nominal_value for E in
+                       decay_obj.average_energies.values())
+    data = DecayData(decay_obj.nuclide,
+                     float(decay_obj.half_life.nominal_value),
+                     float(decay_energy), modes)
+    return decay_obj.nuclide['name'], data
+
+
+@_cached
+def _read_fpy(path):
+    """Read the nuclide name and yields from an ENDF fission product yield
+    sub-library file."""
+    fpy_obj = openmc.data.FissionProductYields(path)
+    independent = [{k: float(v.nominal_value) for k, v in table.items()}
+                   for table in fpy_obj.independent]
+    cumulative = [{k: float(v.nominal_value) for k, v in table.items()}
+                  for table in fpy_obj.cumulative]
+    data = FPYData(fpy_obj.energies, independent, cumulative)
+    return fpy_obj.nuclide['name'], data
+
+
+def _parse_neutron(path):
+    """Read reaction Q values from an ENDF neutron sub-library file.
+
+    Returns a tuple of the nuclide name and a dictionary mapping MT to Q value,
+    or None if the nuclide is not part of the CASL chain.
+
+    """
+    nuc_name, q_values = _read_neutron(path)
+    if nuc_name not in CASL_CHAIN:
+        return None
+    return nuc_name, q_values
+
+
+def _parse_decay(path):
+    """Read an ENDF decay sub-library file.
+
+    Returns a tuple of the nuclide name and its decay data, or None if the
+    nuclide is not part of the CASL chain.
+
+    """
+    nuc_name, decay = _read_decay(path)
+    if nuc_name not in CASL_CHAIN:
+        return None
+    return nuc_name, decay
+
+
+def _parse_fpy(path):
+    """Read an ENDF fission product yield sub-library file.
+
+    Returns a tuple of the nuclide name and its fission product yields, or None
+    if the nuclide is not part of the CASL chain.
+
+    """
+    name, fpy = _read_fpy(path)
+    if name not in CASL_CHAIN:
+        return None
+    return name, fpy
+
+
 def main():
     if os.path.isdir('./decay') and os.path.isdir('./nfy') and os.path.isdir('./neutrons'):
         endf_dir = '.'
     elif 'OPENMC_ENDF_DATA' in os.environ:
         endf_dir = os.environ['OPENMC_ENDF_DATA']
     else:
-        for url in URLS:
-            basename = download(url)
-            with ZipFile(basename, 'r') as zf:
-                print('Extracting {}...'.format(basename))
-                zf.extractall()
+        # Download sub-libraries one at a time so that their progress bars do
+        # not interleave, extracting each in the background while the next one
+        # is downloaded
+        with ThreadPoolExecutor() as executor:
+            extractions = [executor.submit(_extract, download(url))
+                           for url in URLS]
+            for future in extractions:
+                future.result()
         endf_dir = '.'
 
-    decay_files = glob.glob(os.path.join(endf_dir, 'decay', '*.endf'))
-    fpy_files = glob.glob(os.path.join(endf_dir, 'nfy', '*.endf'))
-    neutron_files = glob.glob(os.path.join(endf_dir, 'neutrons', '*.endf'))
+    decay_files = _endf_files(os.path.join(endf_dir, 'decay'))
+    fpy_files = _endf_files(os.path.join(endf_dir, 'nfy'))
+    neutron_files = _endf_files(os.path.join(endf_dir, 'neutrons'))
 
     # Create a Chain
     chain = openmc.deplete.Chain()
 
     print('Reading ENDF nuclear data from "{}"...'.format(os.path.abspath(endf_dir)))
 
-    # Create dictionary mapping target to filename
-    print('Processing neutron sub-library files...')
-    reactions = {}
-    for f in neutron_files:
-        evaluation = openmc.data.endf.Evaluation(f)
-        nuc_name = evaluation.gnd_name
-        if nuc_name in CASL_CHAIN:
-            reactions[nuc_name] = {}
-            for mf, mt, nc, mod in evaluation.reaction_list:
-                # Q value for each reaction is given in MF=3
-                if mf == 3:
-                    file_obj = StringIO(evaluation.section[3, mt])
-                    openmc.data.endf.get_head_record(file_obj)
-                    q_value = openmc.data.endf.get_cont_record(file_obj)[1]
-                    reactions[nuc_name][mt] = q_value
-
-    # Determine what decay and FPY nuclides are available
-    print('Processing decay sub-library files...')
-    decay_data = {}
-    for f in decay_files:
-        decay_obj = openmc.data.Decay(f)
-        nuc_name = decay_obj.nuclide['name']
-        if nuc_name in CASL_CHAIN:
-            decay_data[nuc_name] = decay_obj
-
-    for nuc_name in CASL_CHAIN:
-        if nuc_name not in decay_data:
-            print('WARNING: {} has no decay data!'.format(nuc_name))
-
-    print('Processing fission product yield sub-library files...')
-    fpy_data = {}
-    for f in fpy_files:
-        fpy_obj = openmc.data.FissionProductYields(f)
-        name = fpy_obj.nuclide['name']
-        if name in CASL_CHAIN:
-            fpy_data[name] = fpy_obj
+    # Parse the sub-library files in parallel; each worker returns None for
+    # nuclides that are not part of the CASL chain
+    with Pool() as pool:
+        # Create dictionary mapping target to reaction Q values
+        print('Processing neutron sub-library files...')
+        reactions = {}
+        for result in pool.imap_unordered(_parse_neutron, neutron_files, chunksize=8):
+            if result is not None:
+                nuc_name, q_values = result
+                reactions[nuc_name] = q_values
+
+        # Determine what decay and FPY nuclides are available
+        print('Processing decay sub-library files...')
+        decay_data = {}
+        for result in pool.imap_unordered(_parse_decay, decay_files, chunksize=8):
+            if result is not None:
+                nuc_name, decay = result
+                decay_data[nuc_name] = decay
+
+        for nuc_name in CASL_CHAIN:
+            if nuc_name not in decay_data:
+                print('WARNING: {} has no decay data!'.format(nuc_name))
+
+        print('Processing fission product yield sub-library files...')
+        fpy_data = {}
+        for result in pool.imap_unordered(_parse_fpy, fpy_files, chunksize=8):
+            if result is not None:
+                name, fpy = result
+                fpy_data[name] = fpy
 
     print('Creating depletion_chain...')
     missing_daughter = []
     missing_rx_product = []
     missing_fpy = []
 
+    # Resolve the yield treatment of each product with decay data into
+    # (nuclide, weight, IFPY, required IFPY, label) terms once, so that direct,
+    # cumulative and weighted yields are all summed the same way for every
+    # parent and energy. A term is only used if the nuclide appears in the
+    # table given by the required IFPY; weighted terms are always checked
+    # against the independent yields. The label is used in warnings.
+    fpy_terms = {}
+    for name in decay_data:
+        _, _, ifpy, special = CASL_CHAIN[name]
+        if ifpy == 1:
+            fpy_terms[name] = ((name, 1.0, 1, 1, 'independent '),)
+        elif ifpy == 2:
+            fpy_terms[name] = ((name, 1.0, 2, 2, 'cumulative '),)
+        elif ifpy == 3:
+            fpy_terms[name] = tuple((name_i, weight_i, ifpy_i, 1, '')
+                                    for name_i, weight_i, ifpy_i in special)
+
+    # Set mirroring chain.reactions for fast membership tests; the list itself
+    # is kept to preserve the order reactions are written in
+    reactions_seen = set(chain.reactions)
+
     for idx, parent in enumerate(sorted(decay_data, key=openmc.data.zam)):
         data = decay_data[parent]
 
@@ -104,11 +344,12 @@ def main():
         chain.nuclide_dict[parent] = idx
 
         if not CASL_CHAIN[parent][0] and \
-           not data.nuclide['stable'] and data.half_life.nominal_value != 0.0:
-            nuclide.half_life = data.half_life.nominal_value
-            nuclide.decay_energy = sum(E.nominal_value for E in
-                                       data.average_energies.values())
-            sum_br = 0.0
+           not data.nuclide['stable'] and data.half_life != 0.0:
+            nuclide.half_life = data.half_life
+            nuclide.decay_energy = data.decay_energy
+            # Keep a running sum of branching ratios, as well as the sum
+            # excluding the most recently added mode
+            sum_br = sum_others = 0.0
             for mode in data.modes:
                 decay_type = ','.join(mode.modes)
                 if mode.daughter in decay_data:
@@ -118,55 +359,54 @@ def main():
                     continue
 
                 # Append decay mode
-                br = mode.branching_ratio.nominal_value
+                br = mode.branching_ratio
                 nuclide.decay_modes.append(DecayTuple(decay_type, target, br))
+                sum_others = sum_br
+                sum_br += br
 
             # Ensure sum of branching ratios is unity by slightly modifying last
             # value if necessary
-            sum_br = sum(m.branching_ratio for m in nuclide.decay_modes)
             if sum_br != 1.0 and nuclide.decay_modes and parent not in UNMODIFIED_DECAY_BR:
                 decay_type, target, br = nuclide.decay_modes.pop()
-                br = 1.0 - sum(m.branching_ratio for m in nuclide.decay_modes)
+                br = 1.0 - sum_others
                 nuclide.decay_modes.append(DecayTuple(decay_type, target, br))
 
         # If nuclide has incident neutron data, we need to list what
         # transmutation reactions are possible
         if parent in reactions:
-            reactions_available = reactions[parent].keys()
-            for name, mts, changes in _REACTIONS:
-                if mts & reactions_available:
+            parent_rx = reactions[parent]
+            available_mask = _mt_mask(parent_rx)
+            for name, mts_mask, sorted_mts, changes in _REACTIONS_SORTED:
+                if mts_mask & available_mask:
                     delta_A, delta_Z = changes
                     A = data.nuclide['mass_number'] + delta_A
                     Z = data.nuclide['atomic_number'] + delta_Z
                     daughter = '{}{}'.format(openmc.data.ATOMIC_SYMBOL[Z], A)
 
-                    if name not in chain.reactions:
+                    if name not in reactions_seen:
+                        reactions_seen.add(name)
                         chain.reactions.append(name)
 
                     if daughter not in decay_data:
                         missing_rx_product.append((parent, name, daughter))
                         daughter = 'Nothing'
 
-                    # Store Q value -- use sorted order so we get summation
-                    # reactions (e.g., MT=103) first
-                    for mt in sorted(mts):
-                        if mt in reactions[parent]:
-                            q_value = reactions[parent][mt]
-                            break
-                    else:
-                        q_value = 0.0
+                    # Store Q value of the first available MT
+                    q_value = next((parent_rx[mt] for mt in sorted_mts
+                                    if mt in parent_rx), 0.0)
 
                     nuclide.reactions.append(ReactionTuple(
                         name, daughter, q_value, 1.0))
 
             # Check for fission reactions
-            if any(mt in reactions_available for mt in [18, 19, 20, 21, 38]):
+            if available_mask & _FISSION_MASK:
                 if parent in fpy_data:
-                    q_value = reactions[parent][18]
+                    q_value = parent_rx[18]
                     nuclide.reactions.append(
                         ReactionTuple('fission', 0, q_value, 1.0))
 
-                    if 'fission' not in chain.reactions:
+                    if 'fission' not in reactions_seen:
+                        reactions_seen.add('fission')
                         chain.reactions.append('fission')
                 else:
                     missing_fpy.append(parent)
@@ -181,33 +421,21 @@ def main():
 
             yield_data = {}
             for E, table_yd, table_yc in zip(yield_energies, fpy.independent, fpy.cumulative):
-                yields = defaultdict(float)
-                for product in table_yd:
-                    if product in decay_data:
-                        # identifier
-                        ifpy = CASL_CHAIN[product][2]
-                        # 1 for independent
-                        if ifpy == 1:
-                            if product not in table_yd:
-                                print('No independent fission yields found for {} in {}'.format(product, parent))
-                            else:
-                                yields[product] += table_yd[product].nominal_value
-                        # 2 for cumulative
-                        elif ifpy == 2:
-                            if product not in table_yc:
-                                print('No cumulative fission yields found for {} in {}'.format(product, parent))
-                            else:
-                                yields[product] += table_yc[product].nominal_value
-                        # 3 for special treatment with weight fractions
-                        elif ifpy == 3:
-                            for name_i, weight_i, ifpy_i in CASL_CHAIN[product][3]:
-                                if name_i not in table_yd:
-                                    print('No fission yields found for {} in {}'.format(name_i, parent))
-                                else:
-                                    if ifpy_i == 1:
-                                        yields[product] += weight_i * table_yd[name_i].nominal_value
-                                    elif ifpy_i == 2:
-                                        yields[product] += weight_i * table_yc[name_i].nominal_value
+                yields = {}
+                for product in fpy_terms.keys() & table_yd.keys():
+                    total = 0.0
+                    found = False
+                    for name_i, weight_i, ifpy_i, required_i, label_i in fpy_terms[product]:
+                        # 1 for independent, 2 for cumulative
+                        required = table_yd if required_i == 1 else table_yc
+                        if name_i not in required:
+                            print('No {}fission yields found for {} in {}'.format(label_i, name_i, parent))
+                        else:
+                            table = table_yd if ifpy_i == 1 else table_yc
+                            total += weight_i * table[name_i]
+                            found = True
+                    if found:
+                        yields[product] = total
 
                 yield_data[E] = yields
 
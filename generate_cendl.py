@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from multiprocessing import Pool
 from pathlib import Path
 import sys
 import zipfile
@@ -39,6 +40,10 @@ parser.add_argument('--libver', choices=['earliest', 'latest'],
                     default='latest', help="Output HDF5 versioning. Use "
                     "'earliest' for backwards compatibility or 'latest' for "
                     "performance")
+parser.add_argument('-j', '--jobs', type=int, default=None,
+                    help='Number of files to process with NJOY in parallel. '
+                    'Each process can use about 1 GB of memory. Defaults to '
+                    'the number of CPUs')
 parser.add_argument('-r', '--release', choices=['3.1'],
                     default='3.1', help="The nuclear data library release version. "
                     "The only option currently supported is 3.1")
@@ -60,7 +65,13 @@ release_details = {
         'neutron_files': endf_files_dir.glob('*.C31'),
         'metastables': endf_files_dir.glob('*m.C31'),
         'compressed_file_size': '0.03 GB',
-        'uncompressed_file_size': '0.4 GB'
+        'uncompressed_file_size': '0.4 GB',
+        # the 22-Ti-047.C31 and 5-B-010.C31 files contain non-ASCII characters
+        # so the affected lines are replaced, indexed by line number
+        'fixups': {
+            '22-Ti-047.C31': (205, ' 8) YUAN Junqian,WANG Yongchang,etc.               ,16,(1),57,92012228 1451  205'),
+            '5-B-010.C31': (203, '21)   Day R.B. and Walt M.  Phys.rev.117,1330 (1960)               525 1451  203')
+        }
     }
 }
 
@@ -70,6 +81,24 @@ Extracting and processing the data requires {} of additional free disk space.
 """.format(release_details[args.release]['compressed_file_size'],
            release_details[args.release]['uncompressed_file_size'])
 
+
+def process_neutron(path, output_dir):
+    """Process ENDF neutron sublibrary file into HDF5 and write into a
+    specified output directory. Returns the path of the HDF5 file."""
+    print(f'Converting: {path}')
+    try:
+        data = openmc.data.IncidentNeutron.from_njoy(path)
+    except Exception as e:
+        print(path, e)
+        raise
+
+    # Export HDF5 file
+    h5_file = output_dir / f'{data.name}.h5'
+    print('Writing {}...'.format(h5_file))
+    data.export_to_hdf5(h5_file, 'w', libver=args.libver)
+    return h5_file
+
+
 # ==============================================================================
 # DOWNLOAD FILES FROM WEBSITE
 
@@ -91,35 +120,30 @@ if args.extract:
 # GENERATE HDF5 LIBRARY -- NEUTRON FILES
 
 # Get a list of all ENDF files
-neutron_files = release_details[args.release]['neutron_files']
+neutron_files = sorted(release_details[args.release]['neutron_files'])
 
 # Create output directory if it doesn't exist
 args.destination.mkdir(parents=True, exist_ok=True)
 
 library = openmc.data.DataLibrary()
 
-for filename in sorted(neutron_files):
-
-    # this is a fix for the CENDL 3.1 release where the 22-Ti-047.C31 and 5-B-010.C31 files contain non-ASCII characters
-    if library_name == 'cendl' and args.release == '3.1' and filename.name in  ['22-Ti-047.C31', '5-B-010.C31']:
+# apply manual fixes for files with known errors in this release before any
+# files are processed
+for filename in neutron_files:
+    fixup = release_details[args.release]['fixups'].get(filename.name)
+    if fixup is not None:
         print('Manual fix for incorrect value in ENDF file')
-        text = open(filename, 'rb').read().decode('utf-8','ignore').split('\r\n')
-        if filename.name == '22-Ti-047.C31':
-            text[205] = ' 8) YUAN Junqian,WANG Yongchang,etc.               ,16,(1),57,92012228 1451  205'
-        if filename.name == '5-B-010.C31':
-            text[203] = '21)   Day R.B. and Walt M.  Phys.rev.117,1330 (1960)               525 1451  203'
-        open(filename, 'w').write('\r\n'.join(text))
-
-    print(f'Converting: {filename}')
-    data = openmc.data.IncidentNeutron.from_njoy(filename)
-
-    # Export HDF5 file
-    h5_file = args.destination / f'{data.name}.h5'
-    print('Writing {}...'.format(h5_file))
-    data.export_to_hdf5(h5_file, 'w', libver=args.libver)
-
-    # Register with library
-    library.register_file(h5_file)
+        line_number, line = fixup
+        text = filename.read_bytes().decode('utf-8', 'ignore').split('\r\n')
+        text[line_number] = line
+        filename.write_bytes('\r\n'.join(text).encode('utf-8'))
+
+# Convert files in parallel and register them in sorted order
+with Pool(processes=args.jobs) as pool:
+    results = [pool.apply_async(process_neutron, (filename, args.destination))
+               for filename in neutron_files]
+    for r in results:
+        library.register_file(r.get())
 
 # Write cross_sections.xml
 library.export_to_xml(args.destination / 'cross_sections.xml')